@@ -0,0 +1,29 @@
+# Gunicorn configuration for the Tokopedia Scraper API
+# Usage: gunicorn -c gunicorn.conf.py server:app
+import multiprocessing
+import os
+
+# Bind to the same HTTPS port the dev server used
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8443")
+
+# Threaded workers so slow /scrape calls don't block /health and friends
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+# Keep client connections open between requests (n8n polls frequently)
+keepalive = 30
+
+# Scrapes can take a while - allow them to finish
+timeout = 60
+
+# Heartbeat files on tmpfs avoid worker stalls on slow container disks
+worker_tmp_dir = "/dev/shm"
+
+# TLS - set SSL_CERTFILE/SSL_KEYFILE to empty when a proxy terminates TLS
+certfile = os.getenv("SSL_CERTFILE", "certs/cert.pem") or None
+keyfile = os.getenv("SSL_KEYFILE", "certs/key.pem") or None
+
+accesslog = "-"
+errorlog = "-"
+loglevel = "info"
@@ -1,32 +1,334 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
+from concurrent.futures import Future
 from datetime import datetime
+from glob import glob
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
+import orjson
 import logging
-import sys
 import os
+import pstats
 import ssl
+import threading
+import time
 
-# Add src to path to import scraper
-sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
-from scraper import scrape_tokopedia
+from src import scrape_tokopedia
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson, used by jsonify and request.get_json"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Enable CORS for n8n access
 CORS(app)
 
+# Compress larger responses (mainly /scrape) with brotli, falling back to gzip
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 500
+Compress(app)
+
+# Static payloads, built once instead of on every request
+ROOT_INFO = {
+    "message": "Tokopedia Scraper API with Enhanced Features",
+    "version": "1.0.0",
+    "features": [
+        "Shop rating and recommendation system",
+        "Bestseller detection",
+        "Trending product identification",
+        "Enhanced product analytics"
+    ],
+    "endpoints": {
+        "GET /health": "Health check",
+        "POST /scrape": "Scrape products with enhanced analytics - expects JSON {'query': 'search term', 'num_products': 10}",
+        "GET /shops/recommended": "Get recommended shops",
+        "GET /products/bestsellers": "Get bestseller products"
+    },
+    "usage_example": {
+        "scrape": "curl -k -X POST https://localhost:8443/scrape -H 'Content-Type: application/json' -d '{\"query\": \"decal mx king 150\", \"num_products\": 5}'",
+        "recommended_shops": "curl -k https://localhost:8443/shops/recommended",
+        "bestsellers": "curl -k https://localhost:8443/products/bestsellers"
+    }
+}
+ROOT_BODY = orjson.dumps(ROOT_INFO)
+ROOT_ETAG = hashlib.blake2b(ROOT_BODY, digest_size=8).hexdigest()
+
+# This is a simplified version - in production, you'd cache this data
+# For now, we'll return a sample response
+SAMPLE_RECOMMENDED_SHOPS = [
+    {
+        "id": 1,
+        "name": "Top Rated Shop Example",
+        "city": "Jakarta",
+        "isOfficial": True,
+        "isPowerBadge": True,
+        "avgRating": 4.8,
+        "totalReviews": 1250,
+        "recommendationScore": 92.5,
+        "specialties": ["Electronics", "Accessories"]
+    }
+]
+
+# This would typically fetch from a cached database
+# For now, return a sample response
+SAMPLE_BESTSELLERS = [
+    {
+        "name": "Popular Product Example",
+        "price": "Rp150.000",
+        "rating": 4.9,
+        "reviewCount": 500,
+        "isBestSeller": True,
+        "popularityScore": 4.2,
+        "shop": {
+            "name": "Top Shop",
+            "isOfficial": True,
+            "recommendationScore": 95.0
+        }
+    }
+]
+
+# (second, ISO string) of the last formatted timestamp
+_timestamp = (0, "")
+
+def iso_now():
+    """Current UTC time as an ISO string, formatted at most once per second"""
+    global _timestamp
+    now = int(time.time())
+    if _timestamp[0] != now:
+        _timestamp = (now, datetime.utcfromtimestamp(now).isoformat())
+    return _timestamp[1]
+
+# Serialized bodies of timestamped static endpoints: name -> (second, body, etag)
+_body_cache = {}
+
+def cached_json_body(name, build):
+    """
+    Return the serialized JSON body and its ETag for a static endpoint.
+
+    The body only carries a timestamp that changes, so it is rebuilt at most
+    once per second; build(timestamp) returns the payload dict.
+    """
+    now = int(time.time())
+    cached = _body_cache.get(name)
+    if cached is None or cached[0] != now:
+        body = orjson.dumps(build(iso_now()))
+        cached = (now, body, hashlib.blake2b(body, digest_size=8).hexdigest())
+        _body_cache[name] = cached
+    return cached[1], cached[2]
+
+def scrape_cache_key(query, num_products):
+    """
+    Cache key for a scrape: case and whitespace variants of a query share
+    one fixed-size key
+    """
+    normalized = ' '.join(query.lower().split())
+    return hashlib.blake2b(f"{normalized}:{num_products}".encode('utf-8'), digest_size=16).digest()
+
+# In-process cache of serialized /scrape responses:
+# key -> (expiry, body, gzipped body, query start, query end)
+SCRAPE_CACHE_TTL = int(os.getenv("SCRAPE_CACHE_TTL", 300))
+# How long past expiry an entry may still be served when Tokopedia fails
+SCRAPE_CACHE_MAX_STALE = int(os.getenv("SCRAPE_CACHE_MAX_STALE", 86400))
+SCRAPE_CACHE_MAX_ENTRIES = 1024
+_scrape_cache = {}
+_scrape_cache_lock = threading.Lock()
+
+# Where the echoed query starts in a serialized /scrape body; "query" is
+# emitted before any product data, so the first match is always ours
+_QUERY_FIELD = b'"query":'
+
+def scrape_body_for_query(entry, query):
+    """
+    Return (body, gzipped body) from a cache entry, echoing query as this
+    caller sent it. Entries shared by a normalized variant of the query get
+    the query spliced in and no pre-gzipped copy (Flask-Compress handles it).
+    """
+    _, body, gzipped, start, end = entry
+    encoded_query = orjson.dumps(query)
+    if body[start:end] == encoded_query:
+        return body, gzipped
+    return body[:start] + encoded_query + body[end:], None
+
+def get_cached_scrape(key, query, allow_stale=False):
+    """
+    Return the cached (body, gzipped body) for key, or None if missing/expired.
+    With allow_stale, expired entries within SCRAPE_CACHE_MAX_STALE are returned too.
+    """
+    hit = _scrape_cache.get(key)
+    if hit:
+        expiry = hit[0] + SCRAPE_CACHE_MAX_STALE if allow_stale else hit[0]
+        if expiry > time.monotonic():
+            return scrape_body_for_query(hit, query)
+    return None
+
+def cache_scrape(key, body, query):
+    """
+    Store a serialized /scrape response along with its gzipped form,
+    evicting expired then oldest entries when full. Returns the cache entry.
+    """
+    gzipped = gzip.compress(body, compresslevel=4)
+    query_start = body.index(_QUERY_FIELD) + len(_QUERY_FIELD)
+    query_end = query_start + len(orjson.dumps(query))
+    now = time.monotonic()
+    with _scrape_cache_lock:
+        # Re-insert refreshed keys at the end so eviction order tracks age
+        _scrape_cache.pop(key, None)
+        if len(_scrape_cache) >= SCRAPE_CACHE_MAX_ENTRIES:
+            for expired_key in [k for k, entry in _scrape_cache.items() if entry[0] <= now]:
+                del _scrape_cache[expired_key]
+            while len(_scrape_cache) >= SCRAPE_CACHE_MAX_ENTRIES:
+                del _scrape_cache[next(iter(_scrape_cache))]
+        entry = _scrape_cache[key] = (now + SCRAPE_CACHE_TTL, body, gzipped, query_start, query_end)
+    return entry
+
+def scrape_response(body, gzipped, cache_status):
+    """Serve a serialized /scrape body, pre-gzipped if available and the client accepts gzip"""
+    headers = {'X-Cache': cache_status}
+    if gzipped is not None and request.accept_encodings['gzip']:
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+        body = gzipped
+    return Response(body, mimetype='application/json', headers=headers)
+
+def build_scrape_body(query, products):
+    """Aggregate a scrape into the serialized /scrape response body"""
+    # Single pass: unique shops, bestsellers, trending and rating totals
+    shops = {}
+    bestsellers = []
+    trending_products = []
+    rating_sum = 0
+    rating_count = 0
+
+    for product in products:
+        shop = product.get('shop') or {}
+        shop_id = shop.get('id')
+        if shop_id and shop_id not in shops:
+            shops[shop_id] = shop
+
+        # Collect bestsellers and trending products
+        if product.get('isBestSeller'):
+            bestsellers.append(product)
+        if product.get('isTrending'):
+            trending_products.append(product)
+
+        rating = product.get('rating')
+        if rating is not None and rating > 0:
+            rating_sum += rating
+            rating_count += 1
+
+    # Top 5 recommended shops by recommendation score
+    recommended_shops = heapq.nlargest(
+        5,
+        shops.values(),
+        key=lambda x: x.get('recommendationScore', 0)
+    )
+
+    # Average over rated products only
+    avg_rating = round(rating_sum / rating_count, 1) if rating_count else 0
+
+    response = {
+        "status": "success",
+        "timestamp": iso_now(),
+        "query": query,
+        "total_products": len(products),
+        "products": products,
+        "bestsellers": bestsellers,
+        "trending_products": trending_products,
+        "recommended_shops": recommended_shops,
+        "summary": {
+            "total_shops": len(shops),
+            "bestseller_count": len(bestsellers),
+            "trending_count": len(trending_products),
+            "avg_product_rating": avg_rating
+    }
+    }
+
+    logger.info(f"Successfully scraped {len(products)} products with {len(bestsellers)} bestsellers and {len(recommended_shops)} recommended shops")
+    return orjson.dumps(response)
+
+# Scrapes currently in progress: cache key -> Future of the cache entry
+_inflight_scrapes = {}
+_inflight_lock = threading.Lock()
+
+def scrape_once(key, query, num_products):
+    """
+    Scrape, build and cache the /scrape body for key, letting concurrent
+    callers with the same cache key wait for the scrape already in flight
+    instead of starting their own. Returns (body, gzipped body) for query.
+
+    The key leaves _inflight_scrapes only after the body is cached, so a
+    request arriving in between always finds one or the other.
+    """
+    with _inflight_lock:
+        future = _inflight_scrapes.get(key)
+        is_leader = future is None
+        if is_leader:
+            # A scrape may have finished since the caller's own cache check
+            cached = get_cached_scrape(key, query)
+            if cached is not None:
+                return cached
+            future = _inflight_scrapes[key] = Future()
+
+    if not is_leader:
+        return scrape_body_for_query(future.result(), query)
+
+    try:
+        products = scrape_tokopedia(query, num_products)
+        entry = cache_scrape(key, build_scrape_body(query, products), query)
+        future.set_result(entry)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight_scrapes.pop(key, None)
+    return scrape_body_for_query(entry, query)
+
+def etag_matches(etag):
+    """Whether the request's If-None-Match covers etag, including compressed variants"""
+    if_none_match = request.if_none_match
+    if if_none_match.star_tag:
+        return True
+    # Flask-Compress suffixes the ETag of compressed responses, e.g. "abc:br"
+    return any(tag.split(':', 1)[0] == etag for tag in if_none_match.as_set(include_weak=True))
+
+def json_response(body, etag=None):
+    """
+    Wrap an already-serialized JSON body in a response, answering with
+    304 Not Modified when the client already holds the same ETag
+    """
+    if etag is not None and etag_matches(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
 @app.route("/health", methods=["GET"])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
+    return json_response(*cached_json_body("health", lambda timestamp: {
         "status": "healthy",
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": timestamp,
         "version": "1.0.0"
-    })
+    }))
 
 @app.route("/scrape", methods=["POST"])
 def scrape_products():
@@ -35,74 +337,42 @@ def scrape_products():
 
     Expects JSON: {"query": "search term", "num_products": 10}
     """
-    try:
-        data = request.get_json()
+    # Validate before the scrape so bad input is a 400, never a 500
+    data = request.get_json(silent=True)
 
-        if not data or 'query' not in data:
-            return jsonify({"error": "Missing 'query' parameter"}), 400
+    if not isinstance(data, dict) or 'query' not in data:
+        return jsonify({"error": "Missing 'query' parameter"}), 400
 
-        query = data['query']
-        num_products = data.get('num_products', 10)
+    query = data['query']
+    num_products = data.get('num_products', 10)
 
-        if not isinstance(num_products, int) or num_products < 1 or num_products > 100:
-            return jsonify({"error": "'num_products' must be between 1 and 100"}), 400
+    if not isinstance(query, str) or not query.strip():
+        return jsonify({"error": "'query' must be a non-empty string"}), 400
 
-        logger.info(f"Scraping products for query: '{query}' (max {num_products} products)")
+    if not isinstance(num_products, int) or num_products < 1 or num_products > 100:
+        return jsonify({"error": "'num_products' must be between 1 and 100"}), 400
 
-        # Perform enhanced scraping
-        products = scrape_tokopedia(query, num_products)
+    cache_key = scrape_cache_key(query, num_products)
+    cached = get_cached_scrape(cache_key, query)
+    if cached is not None:
+        logger.info(f"Cache hit for query: '{query}' (max {num_products} products)")
+        return scrape_response(*cached, 'HIT')
 
-        # Extract unique shops with their metrics
-        shops = {}
-        bestsellers = []
-        trending_products = []
-
-        for product in products:
-            shop_id = product.get('shop', {}).get('id')
-            if shop_id and shop_id not in shops:
-                shops[shop_id] = product['shop']
-
-            # Collect bestsellers and trending products
-            if product.get('isBestSeller'):
-                bestsellers.append(product)
-            if product.get('isTrending'):
-                trending_products.append(product)
-
-        # Sort shops by recommendation score
-        recommended_shops = sorted(
-            list(shops.values()),
-            key=lambda x: x.get('recommendationScore', 0),
-            reverse=True
-        )[:5]  # Top 5 recommended shops
-
-        # Calculate average rating safely
-        rated_products = [p for p in products if p.get('rating') is not None and p.get('rating') > 0]
-        avg_rating = 0
-        if rated_products:
-            try:
-                avg_rating = round(sum(p.get('rating', 0) for p in rated_products) / len(rated_products), 1)
-            except ZeroDivisionError:
-                avg_rating = 0
+    try:
+        logger.info(f"Scraping products for query: '{query}' (max {num_products} products)")
 
-        response = {
-            "status": "success",
-            "timestamp": datetime.utcnow().isoformat(),
-            "query": query,
-            "total_products": len(products),
-            "products": products,
-            "bestsellers": bestsellers,
-            "trending_products": trending_products,
-            "recommended_shops": recommended_shops,
-            "summary": {
-                "total_shops": len(shops),
-                "bestseller_count": len(bestsellers),
-                "trending_count": len(trending_products),
-                "avg_product_rating": avg_rating
-        }
-        }
+        # Perform enhanced scraping (deduplicated across concurrent requests),
+        # falling back to an expired cache entry if Tokopedia is unavailable
+        try:
+            body, gzipped = scrape_once(cache_key, query, num_products)
+        except Exception as e:
+            stale = get_cached_scrape(cache_key, query, allow_stale=True)
+            if stale is None:
+                raise
+            logger.warning(f"Scraping failed for query '{query}', serving stale cache: {str(e)}")
+            return scrape_response(*stale, 'STALE')
 
-        logger.info(f"Successfully scraped {len(products)} products with {len(bestsellers)} bestsellers and {len(recommended_shops)} recommended shops")
-        return jsonify(response)
+        return scrape_response(body, gzipped, 'MISS')
 
     except Exception as e:
         logger.error(f"Scraping failed: {str(e)}")
@@ -114,28 +384,12 @@ def get_recommended_shops():
     Get recommended shops based on overall performance and ratings
     """
     try:
-        # This is a simplified version - in production, you'd cache this data
-        # For now, we'll return a sample response
-        sample_shops = [
-            {
-                "id": 1,
-                "name": "Top Rated Shop Example",
-                "city": "Jakarta",
-                "isOfficial": True,
-                "isPowerBadge": True,
-                "avgRating": 4.8,
-                "totalReviews": 1250,
-                "recommendationScore": 92.5,
-                "specialties": ["Electronics", "Accessories"]
-            }
-        ]
-
-        return jsonify({
+        return json_response(*cached_json_body("recommended_shops", lambda timestamp: {
             "status": "success",
-            "timestamp": datetime.utcnow().isoformat(),
-            "recommended_shops": sample_shops,
+            "timestamp": timestamp,
+            "recommended_shops": SAMPLE_RECOMMENDED_SHOPS,
             "note": "This endpoint returns cached/pre-calculated shop recommendations"
-        })
+        }))
 
     except Exception as e:
         logger.error(f"Failed to get recommended shops: {str(e)}")
@@ -147,30 +401,12 @@ def get_bestsellers():
     Get current bestseller products across categories
     """
     try:
-        # This would typically fetch from a cached database
-        # For now, return a sample response
-        sample_bestsellers = [
-            {
-                "name": "Popular Product Example",
-                "price": "Rp150.000",
-                "rating": 4.9,
-                "reviewCount": 500,
-                "isBestSeller": True,
-                "popularityScore": 4.2,
-                "shop": {
-                    "name": "Top Shop",
-                    "isOfficial": True,
-                    "recommendationScore": 95.0
-                }
-            }
-        ]
-
-        return jsonify({
+        return json_response(*cached_json_body("bestsellers", lambda timestamp: {
             "status": "success",
-            "timestamp": datetime.utcnow().isoformat(),
-            "bestsellers": sample_bestsellers,
+            "timestamp": timestamp,
+            "bestsellers": SAMPLE_BESTSELLERS,
             "note": "This endpoint returns cached bestseller data"
-        })
+        }))
 
     except Exception as e:
         logger.error(f"Failed to get bestsellers: {str(e)}")
@@ -179,27 +415,77 @@ def get_bestsellers():
 @app.route("/", methods=["GET"])
 def root():
     """Root endpoint with API information"""
-    return jsonify({
-        "message": "Tokopedia Scraper API with Enhanced Features",
-        "version": "1.0.0",
-        "features": [
-            "Shop rating and recommendation system",
-            "Bestseller detection",
-            "Trending product identification",
-            "Enhanced product analytics"
-        ],
-        "endpoints": {
-            "GET /health": "Health check",
-            "POST /scrape": "Scrape products with enhanced analytics - expects JSON {'query': 'search term', 'num_products': 10}",
-            "GET /shops/recommended": "Get recommended shops",
-            "GET /products/bestsellers": "Get bestseller products"
-        },
-        "usage_example": {
-            "scrape": "curl -k -X POST https://localhost:8443/scrape -H 'Content-Type: application/json' -d '{\"query\": \"decal mx king 150\", \"num_products\": 5}'",
-            "recommended_shops": "curl -k https://localhost:8443/shops/recommended",
-            "bestsellers": "curl -k https://localhost:8443/products/bestsellers"
-        }
-    })
+    return json_response(ROOT_BODY, ROOT_ETAG)
+
+# Opt-in request profiling - nothing is installed unless FLASK_PROFILE=1
+if os.getenv("FLASK_PROFILE") == "1":
+    from werkzeug.middleware.profiler import ProfilerMiddleware
+
+    PROFILE_DIR = os.getenv("FLASK_PROFILE_DIR", "/tmp/profiles")
+    # Oldest .prof files beyond this many are deleted after each request
+    PROFILE_MAX_FILES = int(os.getenv("FLASK_PROFILE_MAX_FILES", 200))
+    # Required in X-Profile-Token for /debug/pstats; unset means loopback only
+    PROFILE_TOKEN = os.getenv("FLASK_PROFILE_TOKEN", "")
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler = ProfilerMiddleware(app.wsgi_app, restrictions=[30], profile_dir=PROFILE_DIR)
+
+    def profile_mtime(path):
+        """Modification time of a profile, or 0 if another worker removed it"""
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+
+    def prune_profiles():
+        """Keep only the newest PROFILE_MAX_FILES profiles in PROFILE_DIR"""
+        profiles = glob(os.path.join(PROFILE_DIR, '*.prof'))
+        if len(profiles) <= PROFILE_MAX_FILES:
+            return
+        profiles.sort(key=profile_mtime)
+        for path in profiles[:len(profiles) - PROFILE_MAX_FILES]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def profiled_wsgi_app(environ, start_response):
+        try:
+            return profiler(environ, start_response)
+        finally:
+            prune_profiles()
+
+    app.wsgi_app = profiled_wsgi_app
+
+    def profile_access_allowed():
+        """Whether the caller may read profiles: matching token, or loopback without one"""
+        if PROFILE_TOKEN:
+            supplied = request.headers.get('X-Profile-Token', '')
+            return hmac.compare_digest(supplied.encode('utf-8'), PROFILE_TOKEN.encode('utf-8'))
+        return request.remote_addr in ('127.0.0.1', '::1')
+
+    @app.route("/debug/pstats", methods=["GET"])
+    def debug_pstats():
+        """Top functions by cumulative time across all profiled requests"""
+        if not profile_access_allowed():
+            return jsonify({"error": "Forbidden"}), 403
+
+        limit = request.args.get('limit', 30, type=int)
+        stream = io.StringIO()
+        stats = None
+        for path in glob(os.path.join(PROFILE_DIR, '*.prof')):
+            try:
+                if stats is None:
+                    stats = pstats.Stats(path, stream=stream)
+                else:
+                    stats.add(path)
+            except (EOFError, ValueError, TypeError, OSError):
+                # Still being written by another worker, or already pruned
+                continue
+        if stats is None:
+            return jsonify({"error": "No profiles recorded yet"}), 404
+
+        stats.sort_stats('cumulative').print_stats(limit)
+        return Response(stream.getvalue(), mimetype='text/plain')
 
 def create_ssl_context():
     """Create SSL context for HTTPS"""
@@ -208,11 +494,13 @@ def create_ssl_context():
     return context
 
 if __name__ == "__main__":
-    # Run with SSL for local development
+    # Local development only - in production run under gunicorn:
+    #   gunicorn -c gunicorn.conf.py server:app
     ssl_context = create_ssl_context()
     app.run(
         host="0.0.0.0",
         port=8443,
         ssl_context=ssl_context,
-        debug=True
+        threaded=True,
+        debug=False
     )
\ No newline at end of file
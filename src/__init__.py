@@ -0,0 +1,4 @@
+"""Tokopedia scraper package"""
+from .scraper import scrape_tokopedia
+
+__all__ = ["scrape_tokopedia"]
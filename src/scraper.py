@@ -1,12 +1,95 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 from typing import List, Dict, Any
-from datetime import datetime, timedelta
-import time
+from bisect import bisect_left
+from functools import lru_cache
+import logging
+import math
+import re
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+# Shared HTTP session so repeat scrapes reuse keep-alive connections to
+# Tokopedia instead of paying a TCP + TLS handshake per request. With
+# brotli installed requests advertises br in Accept-Encoding on its own
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=16,
+    # Search is read-only, so POST is safe to retry on gateway hiccups; the
+    # last response is returned rather than raised so its body is reported.
+    # Retry-After is ignored so a gateway can't park a worker thread for
+    # longer than the short backoff
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504),
+                      allowed_methods=None, raise_on_status=False,
+                      respect_retry_after_header=False)
+))
+
+GRAPHQL_URL = 'https://gql.tokopedia.com/'
+
+# Search pages are a few hundred KB at most; anything larger is an error
+# page or abuse and is refused rather than buffered
+MAX_RESPONSE_BYTES = 4 * 1024 * 1024
+
+GRAPHQL_HEADERS = {
+    'Content-Type': 'application/json',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# GraphQL product search query. Only fields scrape_tokopedia never reads or
+# returns are trimmed; badges, labelGroups and shop are passed through to
+# clients whole, so their selections (including __typename) stay intact
+SEARCH_PRODUCT_QUERY = '''
+query SearchProductQueryV4($params: String!) {
+    ace_search_product_v4(params: $params) {
+        data {
+            products {
+                id
+                name
+                price
+                rating
+                countReview
+                url
+                badges {
+                    title
+                    imageUrl
+                    show
+                    __typename
+                }
+                labelGroups {
+                    position
+                    title
+                    type
+                    __typename
+                }
+                discountPercentage
+                originalPrice
+                shop {
+                    id
+                    name
+                    url
+                    city
+                    isOfficial
+                    isPowerBadge
+                    __typename
+                }
+            }
+        }
+    }
+}
+'''
 
-# Simple in-memory cache for shop scores
-_shop_score_cache = {}
-_cache_expiry = {}
+# Prices come back formatted for display (e.g. "Rp150.000"); the first
+# number wins so ranges like "Rp10.000 - Rp20.000" parse to the low end
+_PRICE_NUMBER = re.compile(r'\d[\d.]*')
+
+# Review-count tiers for calculate_shop_score: a count strictly above
+# _REVIEW_THRESHOLDS[i] earns _REVIEW_SCORES[i + 1]
+_REVIEW_THRESHOLDS = (50, 100, 500, 1000)
+_REVIEW_SCORES = (0, 5, 10, 15, 20)
 
 def calculate_shop_score(shop_data: Dict[str, Any]) -> float:
     """
@@ -19,13 +102,27 @@ def calculate_shop_score(shop_data: Dict[str, Any]) -> float:
     - Discount offerings (10% weight)
     - Product count/popularity (5% weight)
     """
+    return _score_from_stats(
+        bool(shop_data.get('isOfficial', False)),
+        bool(shop_data.get('isPowerBadge', False)),
+        shop_data.get('avgRating', 0),
+        shop_data.get('totalReviews', 0),
+        shop_data.get('avgDiscountPercent', 0),
+        shop_data.get('productCount', 0)
+    )
+
+# Shop stats are rounded before scoring, so tail shops with identical
+# numbers share a cache entry
+@lru_cache(maxsize=4096)
+def _score_from_stats(is_official: bool, is_power_badge: bool, avg_rating: float,
+                      review_count: int, avg_discount: float, product_count: int) -> float:
     score = 0
 
     # Official and Power Badge bonus (35% of score)
     badge_score = 0
-    if shop_data.get('isOfficial', False):
+    if is_official:
         badge_score += 25
-    if shop_data.get('isPowerBadge', False):
+    if is_power_badge:
         badge_score += 10
 
     score += badge_score
@@ -33,43 +130,33 @@ def calculate_shop_score(shop_data: Dict[str, Any]) -> float:
     # Rating-based score (30% weight) - using product ratings as proxy
     # In a real implementation, this would use actual shop ratings
     rating_score = 0
-    avg_rating = shop_data.get('avgRating', 0)
     if avg_rating and avg_rating > 0:
         rating_score = (avg_rating / 5.0) * 30
     score += rating_score
 
     # Review count weight (20%)
-    review_count = shop_data.get('totalReviews', 0)
-    if review_count > 1000:
-        review_count_score = 20
-    elif review_count > 500:
-        review_count_score = 15
-    elif review_count > 100:
-        review_count_score = 10
-    elif review_count > 50:
-        review_count_score = 5
-    else:
-        review_count_score = 0
+    review_count_score = _REVIEW_SCORES[bisect_left(_REVIEW_THRESHOLDS, review_count)]
     score += review_count_score
 
     # Discount offerings (10%) - shops with frequent discounts get higher scores
-    discount_score = min(shop_data.get('avgDiscountPercent', 0), 10)
+    discount_score = min(avg_discount, 10)
     score += discount_score
 
     # Product count/popularity (5%) - shops with more products might be more established
-    product_count = shop_data.get('productCount', 0)
     popularity_score = min(product_count / 10, 5) if product_count > 0 else 0  # Cap at 5 points
     score += popularity_score
 
     return min(100, max(0, score))
 
-def detect_bestseller_indicators(product: Dict[str, Any], all_products: List[Dict[str, Any]]) -> Dict[str, Any]:
+def detect_bestseller_indicators(product: Dict[str, Any], avg_rating: float) -> Dict[str, Any]:
     """
     Analyze product data to detect bestseller indicators
 
-    Returns enhanced product data with bestseller flags
+    avg_rating is the mean positive rating across the current search
+    results, computed once by the caller
+
+    Adds the bestseller flags to product in place and returns it
     """
-    enhanced_product = product.copy()
 
     # Bestseller indicators based on available data
     rating = product.get('rating') or 0  # Ensure we have a number, not None
@@ -94,12 +181,6 @@ def detect_bestseller_indicators(product: Dict[str, Any], all_products: List[Dic
     )
 
     # Top rated in current search
-    all_ratings = []
-    for p in all_products:
-        p_rating = p.get('rating')
-        if p_rating is not None and p_rating > 0:
-            all_ratings.append(p_rating)
-    avg_rating = sum(all_ratings) / len(all_ratings) if all_ratings else 0
     is_top_rated = False
     if rating > 0:
         if avg_rating > 0:
@@ -107,7 +188,7 @@ def detect_bestseller_indicators(product: Dict[str, Any], all_products: List[Dic
         else:
             is_top_rated = rating >= 4.0  # High rating when no average available
 
-    enhanced_product.update({
+    product.update({
         'isBestSeller': is_bestseller,
         'isTrending': is_trending,
         'isTopRated': is_top_rated,
@@ -115,52 +196,104 @@ def detect_bestseller_indicators(product: Dict[str, Any], all_products: List[Dic
         'avgDiscountPercent': discount_percent
     })
 
-    return enhanced_product
+    return product
 
-def enhance_shop_data(shop_data: Dict[str, Any], all_products: List[Dict[str, Any]]) -> Dict[str, Any]:
+def enhance_shop_data(shop_data: Dict[str, Any], shop_products: List[Dict[str, Any]]) -> Dict[str, Any]:
     """
     Enhance shop data with ratings and recommendation scores
+
+    shop_products must already be limited to this shop's products. The
+    aggregates are written into shop_data in place, all at once after every
+    metric has been computed, and it is returned
     """
-    enhanced_shop = shop_data.copy()
 
-    # Calculate shop statistics from products
-    shop_products = [p for p in all_products if p.get('shop', {}).get('id') == shop_data.get('id')]
-    shop_ratings = [p.get('rating', 0) for p in shop_products if p.get('rating')]
-    shop_reviews = [p.get('countReview', 0) for p in shop_products]
-    shop_discounts = [p.get('discountPercentage', 0) for p in shop_products]
+    # Calculate shop statistics from products in a single pass
+    rating_total = 0
+    rating_count = 0
+    total_reviews = 0
+    discount_total = 0
+    for p in shop_products:
+        rating = p.get('rating')
+        if rating:
+            rating_total += rating
+            rating_count += 1
+        total_reviews += p.get('countReview', 0)
+        discount_total += p.get('discountPercentage', 0)
 
     # Shop-level aggregations
-    avg_rating = 0
-    if shop_ratings:
-        try:
-            avg_rating = round(sum(shop_ratings) / len(shop_ratings), 1)
-        except ZeroDivisionError:
-            avg_rating = 0
-
-    avg_discount = 0
-    if shop_discounts:
-        try:
-            avg_discount = round(sum(shop_discounts) / len(shop_discounts), 1)
-        except ZeroDivisionError:
-            avg_discount = 0
+    product_count = len(shop_products)
+    avg_rating = round(rating_total / rating_count, 1) if rating_count else 0
+    avg_discount = round(discount_total / product_count, 1) if product_count else 0
+
+    # Calculate recommendation score before touching shop_data, so a failure
+    # leaves the caller's fallback copy unmodified
+    shop_score = _score_from_stats(
+        bool(shop_data.get('isOfficial', False)),
+        bool(shop_data.get('isPowerBadge', False)),
+        avg_rating,
+        total_reviews,
+        avg_discount,
+        product_count
+    )
 
-    enhanced_shop.update({
+    shop_data.update({
         'avgRating': avg_rating,
-        'totalReviews': sum(shop_reviews),
+        'totalReviews': total_reviews,
         'avgDiscountPercent': avg_discount,
-        'productCount': len(shop_products)
+        'productCount': product_count,
+        'recommendationScore': round(shop_score, 1)
     })
 
-    # Calculate recommendation score
-    shop_score = calculate_shop_score(enhanced_shop)
-    enhanced_shop['recommendationScore'] = round(shop_score, 1)
+    return shop_data
 
-    # Cache the score for performance
-    cache_key = f"shop_{shop_data.get('id')}"
-    _shop_score_cache[cache_key] = shop_score
-    _cache_expiry[cache_key] = time.time() + 3600  # Cache for 1 hour
+def parse_price(price: Any) -> int:
+    """
+    Turn a display price such as "Rp150.000" into whole rupiah (150000), or 0
+    """
+    if isinstance(price, bool):
+        return 0
+    if isinstance(price, (int, float)):
+        return int(price) if math.isfinite(price) else 0
+    if not isinstance(price, str):
+        return 0
+    match = _PRICE_NUMBER.search(price)
+    return int(match.group().replace('.', '')) if match else 0
+
+def build_product_result(product: Dict[str, Any], shop: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Shape an enhanced product into the record returned by the API
+    """
+    get = product.get
+    return {
+        'name': get('name', 'N/A'),
+        'price': get('price', 'N/A'),
+        'priceValue': parse_price(get('price')),
+        'originalPrice': get('originalPrice', 'N/A'),
+        'discountPercentage': get('discountPercentage', 0),
+        'rating': get('rating', 'N/A'),
+        'reviewCount': get('countReview', 0),
+        'url': get('url', 'N/A'),
+        'badges': get('badges', []),
+        'labelGroups': get('labelGroups', []),
+        'isBestSeller': get('isBestSeller', False),
+        'isTrending': get('isTrending', False),
+        'isTopRated': get('isTopRated', False),
+        'popularityScore': get('popularityScore', 0),
+        'shop': shop
+    }
 
-    return enhanced_shop
+def read_capped_body(response: requests.Response) -> bytes:
+    """
+    Read a streamed response body, refusing anything over MAX_RESPONSE_BYTES
+    """
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=65536):
+        size += len(chunk)
+        if size > MAX_RESPONSE_BYTES:
+            raise Exception(f"Response body exceeds {MAX_RESPONSE_BYTES} bytes")
+        chunks.append(chunk)
+    return b''.join(chunks)
 
 def scrape_tokopedia(query: str, num_products: int = 10) -> List[Dict[str, Any]]:
     """
@@ -174,145 +307,75 @@ def scrape_tokopedia(query: str, num_products: int = 10) -> List[Dict[str, Any]]
     Returns:
         List of product dictionaries
     """
-    graphql_url = 'https://gql.tokopedia.com/'
-
-    # Enhanced GraphQL query for product search with shop ratings and bestseller data
-    gql_query = '''
-    query SearchProductQueryV4($params: String!) {
-        ace_search_product_v4(params: $params) {
-            header {
-                totalData
-                totalDataText
-                processTime
-                responseCode
-                errorMessage
-                __typename
-            }
-            data {
-                isQuerySafe
-                products {
-                    id
-                    name
-                    price
-                    imageUrl
-                    rating
-                    countReview
-                    url
-                    badges {
-                        title
-                        imageUrl
-                        show
-                        __typename
-                    }
-                    labelGroups {
-                        position
-                        title
-                        type
-                        __typename
-                    }
-                    discountPercentage
-                    originalPrice
-                    shop {
-                        id
-                        name
-                        url
-                        city
-                        isOfficial
-                        isPowerBadge
-                        __typename
-                    }
-                    __typename
-                }
-                __typename
-            }
-            __typename
-        }
-    }
-    '''
-
     # Build search parameters
-    params = f'q={query.replace(" ", "%20")}&st=product&rows={num_products}&start=0&device=desktop&scheme=https&source=search&safe_search=false&related=true&goldmerchant=false&official=false&ob=23&pmin=0&pmax=0'
+    params = f'q={quote(query, safe="")}&st=product&rows={num_products}&start=0&device=desktop&scheme=https&source=search&safe_search=false&related=true&goldmerchant=false&official=false&ob=23&pmin=0&pmax=0'
 
     payload = {
-        'query': gql_query,
+        'query': SEARCH_PRODUCT_QUERY,
         'variables': {
             'params': params
         }
     }
 
-    headers = {
-        'Content-Type': 'application/json',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-
     try:
-        response = requests.post(graphql_url, json=payload, headers=headers, timeout=10)
-        response.raise_for_status()
+        with _session.post(GRAPHQL_URL, data=orjson.dumps(payload), headers=GRAPHQL_HEADERS,
+                           timeout=10, stream=True) as response:
+            body = read_capped_body(response)
+        if response.status_code >= 400:
+            # Keep the start of the body; the gateway usually explains itself
+            raise Exception(f"HTTP {response.status_code}: {body[:200].decode('utf-8', 'replace')}")
 
-        data = response.json()
+        data = orjson.loads(body)
 
         if 'errors' in data:
             raise Exception(f"GraphQL Errors: {data['errors']}")
 
-        if 'data' in data and 'ace_search_product_v4' in data['data']:
-            result = data['data']['ace_search_product_v4']
-            products = result['data']['products']
-
-            # Process and enhance products with bestseller indicators
-            enhanced_products = []
-            for product in products:
-                enhanced_product = detect_bestseller_indicators(product, products)
-                enhanced_products.append(enhanced_product)
-
-            # Group products by shop and enhance shop data
-            shop_groups = {}
-            for product in enhanced_products:
-                shop_id = product.get('shop', {}).get('id')
-                if shop_id:
-                    if shop_id not in shop_groups:
-                        shop_groups[shop_id] = {
-                            'shop_data': product['shop'],
-                            'products': []
-                        }
-                    shop_groups[shop_id]['products'].append(product)
-
-            # Enhance shop data with aggregated metrics
-            enhanced_shops = {}
-            for shop_id, shop_info in shop_groups.items():
-                try:
-                    enhanced_shops[shop_id] = enhance_shop_data(shop_info['shop_data'], shop_info['products'])
-                except Exception as e:
-                    # Use original shop data if enhancement fails
-                    enhanced_shops[shop_id] = shop_info['shop_data']
-
-            # Build final results with enhanced shop data
-            results = []
-            for product in enhanced_products:
-                shop_id = product.get('shop', {}).get('id')
-                enhanced_shop = enhanced_shops.get(shop_id, product['shop'])
-
-                result = {
-                    'name': product.get('name', 'N/A'),
-                    'price': product.get('price', 'N/A'),
-                    'originalPrice': product.get('originalPrice', 'N/A'),
-                    'discountPercentage': product.get('discountPercentage', 0),
-                    'rating': product.get('rating', 'N/A'),
-                    'reviewCount': product.get('countReview', 0),
-                    'url': product.get('url', 'N/A'),
-                    'badges': product.get('badges', []),
-                    'labelGroups': product.get('labelGroups', []),
-                    'isBestSeller': product.get('isBestSeller', False),
-                    'isTrending': product.get('isTrending', False),
-                    'isTopRated': product.get('isTopRated', False),
-                    'popularityScore': product.get('popularityScore', 0),
-                    'shop': enhanced_shop
-                }
-                results.append(result)
-
-            return results
-        else:
+        # Missing or null sections mean the search came back empty
+        try:
+            products = data['data']['ace_search_product_v4']['data']['products'] or []
+        except (KeyError, TypeError):
             return []
 
+        # Average rating across the search results, shared by every product
+        ratings = [p['rating'] for p in products if p.get('rating') is not None and p['rating'] > 0]
+        avg_rating = sum(ratings) / len(ratings) if ratings else 0
+
+        # Process and enhance products with bestseller indicators
+        for product in products:
+            detect_bestseller_indicators(product, avg_rating)
+
+        # Group products by shop and enhance shop data
+        shop_groups = {}
+        for product in products:
+            shop = product.get('shop') or {}
+            shop_id = shop.get('id')
+            if shop_id:
+                if shop_id not in shop_groups:
+                    shop_groups[shop_id] = {
+                        'shop_data': shop,
+                        'products': []
+                    }
+                shop_groups[shop_id]['products'].append(product)
+
+        # Enhance shop data with aggregated metrics
+        enhanced_shops = {}
+        for shop_id, shop_info in shop_groups.items():
+            try:
+                enhanced_shops[shop_id] = enhance_shop_data(shop_info['shop_data'], shop_info['products'])
+            except Exception as e:
+                # Use original shop data if enhancement fails
+                logger.debug("Shop %s enhancement failed: %s", shop_id, e)
+                enhanced_shops[shop_id] = shop_info['shop_data']
+
+        # Build final results with enhanced shop data
+        results = []
+        append = results.append
+        for product in products:
+            shop = product.get('shop') or {}
+            append(build_product_result(product, enhanced_shops.get(shop.get('id'), shop)))
+
+        return results
+
     except Exception as e:
         raise Exception(f"Scraping error: {str(e)}")
 